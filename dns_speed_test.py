@@ -1,110 +1,307 @@
-import subprocess
 import time
-import re
+import selectors
 import sys
 import json
+import ctypes
+import random
+import socket
+import struct
 import platform
-from typing import List, Dict, Tuple
-from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Iterator
+from collections import deque
+from itertools import count
+from operator import itemgetter
+from functools import lru_cache
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:  # 未安装时退回标准库 json
+    orjson = None
+
+try:
+    import winreg
+except ImportError:  # 非Windows系统
+    winreg = None
+
+DNS_PORT = 53
+DNS_MAX_RESPONSE = 512
+MAX_CONCURRENT_PROBES = 64
+
+# 每个服务器发送 PROBE_COUNT 次查询，间隔 PROBE_INTERVAL 秒，收到 PROBE_QUORUM 个应答即结束
+PROBE_COUNT = 3
+PROBE_INTERVAL = 0.05
+PROBE_TIMEOUT = 0.3
+PROBE_QUORUM = 2
+ADAPTERS_CACHE_TTL = 5.0
+
+# GetAdaptersAddresses 相关常量
+GAA_FLAG_SKIP_ANYCAST = 0x0002
+GAA_FLAG_SKIP_MULTICAST = 0x0004
+GAA_FLAG_SKIP_DNS_SERVER = 0x0008
+ERROR_BUFFER_OVERFLOW = 111
+ERROR_NO_DATA = 232
+IF_OPER_STATUS_UP = 1
+IF_TYPE_SOFTWARE_LOOPBACK = 24
+TCPIP_INTERFACES_KEY = r'SYSTEM\CurrentControlSet\Services\Tcpip\Parameters\Interfaces'
+
+# 预编译的报文格式：每次查询都要打包事务ID，避免每次调用都查询 struct 的格式缓存
+_TXID = struct.Struct('!H')
+
+
+@lru_cache(maxsize=256)
+def _resolve(host: str) -> str:
+    """解析DNS服务器地址，字面IP只做规范化"""
+    try:
+        return socket.inet_ntoa(socket.inet_aton(host))
+    except OSError:
+        return socket.getaddrinfo(host, DNS_PORT, socket.AF_INET, socket.SOCK_DGRAM)[0][4][0]
+
+
+def _build_dns_query(domain: str, txid: int = 0) -> bytearray:
+    """构造DNS请求报文（递归查询 A 记录，单个问题），返回可原地修改事务ID的 bytearray"""
+    header = struct.pack('!HHHHHH', txid, 0x0100, 1, 0, 0, 0)
+    qname = b''.join(bytes([len(label)]) + label
+                     for label in domain.encode('idna').split(b'.') if label)
+    return bytearray(header + qname + b'\x00' + struct.pack('!HH', 1, 1))
+
+
+class IP_ADAPTER_ADDRESSES(ctypes.Structure):
+    """IP_ADAPTER_ADDRESSES_LH 结构，只声明到 OperStatus 为止用到的字段"""
+
+
+IP_ADAPTER_ADDRESSES._fields_ = [
+    ('Length', ctypes.c_uint32),
+    ('IfIndex', ctypes.c_uint32),
+    ('Next', ctypes.POINTER(IP_ADAPTER_ADDRESSES)),
+    ('AdapterName', ctypes.c_char_p),
+    ('FirstUnicastAddress', ctypes.c_void_p),
+    ('FirstAnycastAddress', ctypes.c_void_p),
+    ('FirstMulticastAddress', ctypes.c_void_p),
+    ('FirstDnsServerAddress', ctypes.c_void_p),
+    ('DnsSuffix', ctypes.c_wchar_p),
+    ('Description', ctypes.c_wchar_p),
+    ('FriendlyName', ctypes.c_wchar_p),
+    ('PhysicalAddress', ctypes.c_ubyte * 8),
+    ('PhysicalAddressLength', ctypes.c_uint32),
+    ('Flags', ctypes.c_uint32),
+    ('Mtu', ctypes.c_uint32),
+    ('IfType', ctypes.c_uint32),
+    ('OperStatus', ctypes.c_int),
+]
+
+
+def _list_connected_adapters() -> Dict[str, str]:
+    """通过 iphlpapi.dll 的 GetAdaptersAddresses 获取已连接的IPv4网络适配器，返回 {名称: GUID}"""
+    iphlpapi = ctypes.windll.iphlpapi
+    flags = GAA_FLAG_SKIP_ANYCAST | GAA_FLAG_SKIP_MULTICAST | GAA_FLAG_SKIP_DNS_SERVER
+    size = ctypes.c_uint32(15000)
+    while True:
+        buffer = ctypes.create_string_buffer(size.value)
+        ret = iphlpapi.GetAdaptersAddresses(socket.AF_INET, flags, None, buffer, ctypes.byref(size))
+        if ret != ERROR_BUFFER_OVERFLOW:
+            break
+    if ret == ERROR_NO_DATA:
+        return {}
+    if ret != 0:
+        raise ctypes.WinError(ret)
+
+    adapters = {}
+    adapter = ctypes.cast(buffer, ctypes.POINTER(IP_ADAPTER_ADDRESSES))
+    while adapter:
+        entry = adapter.contents
+        if entry.OperStatus == IF_OPER_STATUS_UP and entry.IfType != IF_TYPE_SOFTWARE_LOOPBACK:
+            adapters[entry.FriendlyName] = entry.AdapterName.decode('ascii')
+        adapter = entry.Next
+    return adapters
+
+
 class DNSSpeedTest:
     def __init__(self):
         # 从配置文件加载DNS服务器列表
         config_path = Path(__file__).parent / 'dns_servers.json'
         try:
-            with open(config_path, 'r', encoding='utf-8') as f:
-                config = json.load(f)
-                self.dns_servers = [(server['ip'], server['name']) for server in config['dns_servers']]
-                self.test_domain = config.get('test_domain', 'www.baidu.com')
-                self.count  = config.get('count',  100) 
-                self.dns_servers  = self.dns_servers[:self.count]  
+            data = config_path.read_bytes()
+            config = orjson.loads(data) if orjson else json.loads(data)
+            self.test_domain = config.get('test_domain', 'www.baidu.com')
+            self.count  = config.get('count',  100) 
+            # 已有足够多的服务器延迟低于阈值时提前结束测试，数量为0表示测试全部服务器
+            self.early_exit_ms = config.get('early_exit_ms', 30)
+            self.early_exit_count = config.get('early_exit_count', 10)
+            self.dns_servers = [(server['ip'], server['name']) for server in config['dns_servers'][:self.count]]
+            # 所有查询报文只有事务ID不同，预先构造好模板，发送时只改写前两个字节
+            self._query_template = _build_dns_query(self.test_domain)
         except Exception as e:
             print(f'加载配置文件失败: {str(e)}')
             sys.exit(1)
         
         self.is_windows = platform.system().lower() == 'windows'
+        self._adapters_cache = None  # (获取时间, {适配器名称: GUID})
+
+    def _probe_all(self) -> Iterator[List[Dict]]:
+        """用一个非阻塞UDP套接字和 selectors 在单线程内测试所有DNS服务器，按完成顺序分批产出结果"""
+        max_workers = min(len(self.dns_servers), MAX_CONCURRENT_PROBES)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        # 同时进行的查询几乎同时发出，应答会集中到达，接收缓冲区要能容纳整批应答以免被内核丢弃
+        batch_size = max_workers * PROBE_COUNT * DNS_MAX_RESPONSE
+        if sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) < batch_size:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, batch_size)
+            except OSError:
+                pass
+        selector = selectors.DefaultSelector()
+        selector.register(sock, selectors.EVENT_READ)
 
-    def ping_dns(self, dns_server: Tuple[str, str]) -> Dict:
-        """测试DNS服务器的响应时间"""
-        ip, name = dns_server
+        waiting = deque(self.dns_servers)  # 尚未开始测试的服务器
+        active = []  # 正在测试的服务器
+        inflight = {}  # (服务器IP, 事务ID) -> 正在测试的服务器
+        # 事务ID从随机起点顺序分配，同时在途的查询远少于65536个，同一IP重复出现时也不会冲突
+        txids = count(random.getrandbits(16))
         try:
-            # 根据操作系统选择不同的ping命令参数
-            if self.is_windows:
-                cmd = ['ping', '-n', '3', '-w', '1000', ip]
-            else:
-                cmd = ['ping', '-c', '3', '-W', '1', ip]
+            while waiting or active:
+                # 丢弃超时的查询，取出已经完成测试的服务器
+                now = time.perf_counter()
+                batch = []
+                for probe in list(active):
+                    for txid, send_time in list(probe['pending'].items()):
+                        if now - send_time >= PROBE_TIMEOUT:
+                            del probe['pending'][txid]
+                            del inflight[(probe['address'], txid)]
 
-            start_time = time.time()
-            result = subprocess.run(cmd, capture_output=True, text=True, encoding='gbk', errors='ignore')
-            
-            # 解析ping结果
-            if result.returncode == 0:
-                if self.is_windows:
-                    match = re.search(r'平均 = (\d+)ms', result.stdout)
-                else:
-                    match = re.search(r'min/avg/max.+= [\d.]+/([\d.]+)/', result.stdout)
-                
-                if match:
-                    latency = float(match.group(1))
-                    return {'ip': ip, 'name': name, 'latency': latency, 'status': 'ok'}
-            
-            return {'ip': ip, 'name': name, 'latency': float('inf'), 'status': 'failed'}
-        except Exception as e:
-            print(f'测试 {name} ({ip}) 时发生错误: {str(e)}')
-            return {'ip': ip, 'name': name, 'latency': float('inf'), 'status': 'error'}
+                    # 收到足够应答，或者所有查询都已发出且没有等待中的查询
+                    if len(probe['rtts']) >= PROBE_QUORUM or (probe['sent'] >= PROBE_COUNT and not probe['pending']):
+                        active.remove(probe)
+                        for txid in probe['pending']:
+                            del inflight[(probe['address'], txid)]
+                        if probe['rtts']:
+                            batch.append({'ip': probe['ip'], 'name': probe['name'],
+                                          'latency': min(probe['rtts']), 'status': 'ok'})
+                        else:
+                            batch.append({'ip': probe['ip'], 'name': probe['name'],
+                                          'latency': float('inf'), 'status': 'failed'})
+
+                # 服务器数量较多时限制同时进行的测试数量，避免瞬间发出过多查询
+                while waiting and len(active) < max_workers:
+                    ip, name = waiting.popleft()
+                    try:
+                        address = _resolve(ip)
+                    except Exception as e:
+                        batch.append({'ip': ip, 'name': name, 'latency': float('inf'), 'status': 'error', 'error': str(e)})
+                        continue
+                    active.append({'ip': ip, 'name': name, 'address': address, 'sent': 0,
+                                   'next_send': now, 'pending': {}, 'rtts': []})
+
+                # 上一轮到达的应答都已读完并记录了时间，此后也还没有发出新的查询，
+                # 调用方在这里输出结果不会推迟对应答的计时
+                if batch:
+                    yield batch
+
+                # 按 PROBE_INTERVAL 的间隔错开发出下一次查询
+                now = time.perf_counter()
+                for probe in active:
+                    if probe['sent'] < PROBE_COUNT and now >= probe['next_send']:
+                        txid = next(txids) & 0xffff
+                        _TXID.pack_into(self._query_template, 0, txid)
+                        send_time = time.perf_counter()
+                        try:
+                            sock.sendto(self._query_template, (probe['address'], DNS_PORT))
+                        except OSError:
+                            pass  # 发送失败按丢包处理
+                        else:
+                            probe['pending'][txid] = send_time
+                            inflight[(probe['address'], txid)] = probe
+                        probe['sent'] += 1
+                        probe['next_send'] = send_time + PROBE_INTERVAL
+
+                if not active:
+                    continue
+
+                # 等待到下一次发送或超时的时间点，期间到达的应答一次性全部读完
+                wakeups = [probe['next_send'] for probe in active if probe['sent'] < PROBE_COUNT]
+                wakeups.extend(send_time + PROBE_TIMEOUT for probe in active for send_time in probe['pending'].values())
+                timeout = max(min(wakeups) - time.perf_counter(), 0)
+                if not selector.select(timeout):
+                    continue
+                while True:
+                    try:
+                        data, addr = sock.recvfrom(DNS_MAX_RESPONSE)
+                    except BlockingIOError:
+                        break
+                    except ConnectionResetError:
+                        continue  # Windows下ICMP端口不可达会体现在后续的 recvfrom 上
+                    recv_time = time.perf_counter()
+                    if len(data) < _TXID.size:
+                        continue
+                    txid = _TXID.unpack_from(data)[0]
+                    probe = inflight.pop((addr[0], txid), None)
+                    if probe is not None:
+                        send_time = probe['pending'].pop(txid)
+                        probe['rtts'].append((recv_time - send_time) * 1000)
+        finally:
+            selector.close()
+            sock.close()
 
     def test_all_dns(self) -> List[Dict]:
         """测试所有DNS服务器的响应时间"""
         print('开始测试DNS服务器延迟...')
         results = []
-        
-        with ThreadPoolExecutor(max_workers=3) as executor:
-            futures = [executor.submit(self.ping_dns, server) for server in self.dns_servers]
-            for future in futures:
-                result = future.result()
+        fast_count = 0
+        # 按完成顺序逐批输出，慢的服务器不会挡住已经返回的结果；每批只用一次 write
+        for batch in self._probe_all():
+            lines = []
+            for result in batch:
                 results.append(result)
-                print(f'{result["name"]} ({result["ip"]}): '
-                      f'{result["latency"]:.1f}ms ({result["status"]})')
-                sys.stdout.flush()  # 实时刷新输出
+                if result['status'] == 'error':
+                    lines.append(f'测试 {result["name"]} ({result["ip"]}) 时发生错误: {result["error"]}')
+                lines.append(f'{result["name"]} ({result["ip"]}): '
+                             f'{result["latency"]:.1f}ms ({result["status"]})')
+
+                if result['latency'] < self.early_exit_ms:
+                    fast_count += 1
+                if self.early_exit_count and fast_count >= self.early_exit_count:
+                    lines.append(f'已有 {fast_count} 个DNS服务器延迟低于 {self.early_exit_ms}ms，跳过剩余服务器')
+                    break
+            sys.stdout.write('\n'.join(lines) + '\n')
+            if self.early_exit_count and fast_count >= self.early_exit_count:
+                break
         
-        return sorted(results, key=lambda x: x['latency'])
+        return sorted(results, key=itemgetter('latency'))
 
-    def get_network_adapters(self) -> List[str]:
-        """获取所有已启用的网络适配器"""
-        adapters = []
-        try:
-            cmd = ['netsh', 'interface', 'ipv4', 'show', 'interfaces']
-            result = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8', errors='replace')
-            
-            if not result.stdout:
-                print('获取网络适配器信息失败：命令输出为空')
-                return adapters
+    def get_network_adapters(self) -> Dict[str, str]:
+        """获取所有已启用的网络适配器，返回 {名称: GUID}，短时间内重复调用直接使用缓存结果"""
+        if self._adapters_cache is not None:
+            timestamp, adapters = self._adapters_cache
+            if time.monotonic() - timestamp < ADAPTERS_CACHE_TTL:
+                return dict(adapters)
 
-            lines = result.stdout.splitlines()
-            
-            # 查找已启用的接口
-            for line in lines:
-                if line and line.strip():
-                    # 检查是否包含"已连接"或"connected"状态
-                    if '已连接' in line:
-                        adapter = line.split('已连接')[-1].strip()
-                        if adapter:
-                            adapters.append(adapter)
-                    elif 'connected' in line:
-                        adapter = line.split('connected')[-1].strip()
-                        if adapter:
-                            adapters.append(adapter)
+        try:
+            adapters = _list_connected_adapters()
         except Exception as e:
             print(f'获取网络适配器列表时发生错误: {str(e)}')
-        
-        return adapters
+            return {}
+
+        if adapters:
+            self._adapters_cache = (time.monotonic(), adapters)
+        return dict(adapters)
+
+    def _write_dns_settings(self, guid: str, dns_servers: List[str]):
+        """将DNS服务器写入指定GUID适配器的注册表配置，并通知系统立即生效"""
+        key_path = f'{TCPIP_INTERFACES_KEY}\\{guid}'
+        with winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, key_path, 0, winreg.KEY_SET_VALUE) as key:
+            winreg.SetValueEx(key, 'NameServer', 0, winreg.REG_SZ, ','.join(dns_servers))
+
+        # 通知DHCP客户端服务重新加载该适配器的配置
+        ret = ctypes.windll.dhcpcsvc.DhcpNotifyConfigChange(None, guid, False, 0, 0, 0, 0)
+        if ret != 0:
+            raise ctypes.WinError(ret)
 
     def set_dns_windows(self, dns_servers: List[str]) -> bool: 
         """在Windows系统中设置DNS服务器""" 
         try: 
-            # 获取网络适配器列表 
-            adapters = self.get_network_adapters()
+            # 获取网络适配器列表及其GUID 
+            adapter_guids = self.get_network_adapters()
+            adapters = list(adapter_guids)
             
             if not adapters: 
                 print('\n未找到已启用的网络适配器，可能的原因：') 
@@ -133,22 +330,12 @@ class DNSSpeedTest:
             
             print(f'\n正在设置网络适配器 {adapter} 的DNS服务器...') 
             
-            # 设置主DNS 
-            cmd = ['netsh', 'interface', 'ipv4', 'set', 'dns', 
-                f'"{adapter}"', 'static', dns_servers[0]]  # 给适配器名称加双引号 
-            print(f'执行命令: {" ".join(cmd)}') 
-            subprocess.run(cmd,  check=True, capture_output=True, text=True, encoding='gbk', errors='ignore') 
-            
-            # 设置备用DNS 
-            if len(dns_servers) > 1: 
-                cmd = ['netsh', 'interface', 'ipv4', 'add', 'dns', 
-                    f'"{adapter}"', dns_servers[1], 'index=2']  # 给适配器名称加双引号 
-                print(f'执行命令: {" ".join(cmd)}') 
-                subprocess.run(cmd,  check=True, capture_output=True, text=True, encoding='gbk', errors='ignore') 
+            # 设置主DNS和备用DNS
+            self._write_dns_settings(adapter_guids[adapter], dns_servers[:2])
             
             print(f'已成功设置网络适配器 {adapter} 的DNS服务器') 
             return True 
-        except subprocess.CalledProcessError as e: 
+        except OSError as e: 
             print(f'设置DNS时发生错误: {str(e)}') 
             return False 
         except Exception as e: 
@@ -157,6 +344,9 @@ class DNSSpeedTest:
 
     def run(self):
         """运行DNS测速和自动切换"""
+        # 行缓冲：写入的内容含换行时立即刷新，每批测试结果和后续提示都会马上显示
+        sys.stdout.reconfigure(line_buffering=True)
+
         if not self.is_windows:
             print('当前仅支持Windows系统')
             return
@@ -170,14 +360,16 @@ class DNSSpeedTest:
         print('\n测试完成！')
         print('='*50)
         
+        # 结果已按延迟排序，不可用的服务器都在末尾，只需检查前三个
+        available = [r for r in results[:3] if r['status'] == 'ok']
+
         # 显示最快的DNS服务器
         print('\n延迟最低的DNS服务器:')
-        for i, result in enumerate(results[:3], 1):
-            if result['latency'] != float('inf'):
-                print(f'{i}. {result["name"]} ({result["ip"]}): {result["latency"]:.1f}ms')
+        for i, result in enumerate(available, 1):
+            print(f'{i}. {result["name"]} ({result["ip"]}): {result["latency"]:.1f}ms')
         
         # 选择最快的两个DNS服务器
-        fastest_dns = [r['ip'] for r in results[:2] if r['latency'] != float('inf')]
+        fastest_dns = [r['ip'] for r in available[:2]]
         if len(fastest_dns) < 2:
             print('\n没有足够的可用DNS服务器')
             return
@@ -194,13 +386,8 @@ class DNSSpeedTest:
 if __name__ == '__main__':
     # 检查是否以管理员权限运行
     if platform.system().lower() == 'windows':
-        try:
-            is_admin = subprocess.run(['net', 'session'], capture_output=True).returncode == 0
-            if not is_admin:
-                print('请以管理员权限运行此程序')
-                print('请使用 run_dns_test.vbs 启动程序')
-                sys.exit(1)
-        except:
+        is_admin = bool(ctypes.windll.shell32.IsUserAnAdmin())
+        if not is_admin:
             print('请以管理员权限运行此程序')
             print('请使用 run_dns_test.vbs 启动程序')
             sys.exit(1)